@@ -1,7 +1,12 @@
 import os
+import itertools
 import logging
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, render_template, request, redirect, url_for, session, flash, g, get_flashed_messages
 from collections import defaultdict
 
 # Configure logging
@@ -10,25 +15,95 @@ logging.basicConfig(level=logging.DEBUG)
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "zen-food-tracker-secret-key")
 
+# A single purchase as read back from the transactions table for the dashboards
+@dataclass(slots=True)
+class Transaction:
+    user_id: str
+    buyer_name: str
+    item_id: str
+    item_name: str
+    stall_owner: str
+    price: float
+    quantity: int
+    total_price: float
+    timestamp: datetime
+
 # In-memory data storage
-users = {}  # {user_id: {'name': str, 'role': str}}
+users = {}  # {user_id: {'name': str, 'name_lower': str, 'role': str}}
+users_by_key = {}  # {(name_lower, role): user_id}
 menu_items = {}  # {item_id: {'name': str, 'price': float, 'stall_owner': str}}
-sales = []  # [{'item_id': int, 'quantity': int, 'total': float, 'timestamp': datetime, 'stall_owner': str}]
-purchases = []  # [{'user_id': str, 'item_id': int, 'item_name': str, 'stall_name': str, 'price': float, 'timestamp': datetime}]
+menu_by_owner = defaultdict(dict)  # {stall_owner: {item_id: item}}, items shared with menu_items
+_stalls_cache = None  # Menu grouped by stall for browse_menu; reset whenever the menu changes
+
+# Transactions live in an in-process SQLite table so dashboard sums run in SQL;
+# timestamps are stored as POSIX seconds. The lock serializes use of the shared connection.
+db = sqlite3.connect(':memory:', check_same_thread=False)
+db_lock = threading.Lock()
+db.executescript('''
+    CREATE TABLE transactions (
+        id INTEGER PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        buyer_name TEXT NOT NULL,
+        item_id TEXT NOT NULL,
+        item_name TEXT NOT NULL,
+        stall_owner TEXT NOT NULL,
+        price REAL NOT NULL,
+        quantity INTEGER NOT NULL,
+        total_price REAL NOT NULL,
+        timestamp REAL NOT NULL
+    );
+    CREATE INDEX idx_user_ts ON transactions (user_id, timestamp);
+    CREATE INDEX idx_stall_ts ON transactions (stall_owner, timestamp);
+''')
+TRANSACTION_COLUMNS = 'user_id, buyer_name, item_id, item_name, stall_owner, price, quantity, total_price, timestamp'
+
+# Rendered dashboards, reused until the owner's data changes or the timeout passes
+DASHBOARD_CACHE_TIMEOUT = 60  # seconds; bounds staleness of the time-based spend windows
+_dashboard_cache = {}  # {(view, key): (version, expires_at, html)}
+last_write_for_user = defaultdict(int)  # {user_id: version}, bumped on each purchase
+last_write_for_stall = defaultdict(int)  # {stall_owner: version}, bumped on each sale or menu change
+
+# Auto-incrementing IDs (next() on a count is atomic, so concurrent requests can't collide)
+_user_id_gen = itertools.count(1)
+_item_id_gen = itertools.count(1)
+
+def get_cached_dashboard(view, key, version):
+    # Pages with pending flash messages are always rendered fresh
+    if get_flashed_messages():
+        return None
+    entry = _dashboard_cache.get((view, key))
+    if entry and entry[0] == version and entry[1] > time.monotonic():
+        return entry[2]
+    return None
+
+def cache_dashboard(view, key, version, html):
+    if not get_flashed_messages():
+        _dashboard_cache[(view, key)] = (version, time.monotonic() + DASHBOARD_CACHE_TIMEOUT, html)
+    return html
 
-# Auto-incrementing IDs
-next_user_id = 1
-next_item_id = 1
+def recent_transactions(column, value, limit=10):
+    # column is 'user_id' or 'stall_owner', never user input
+    with db_lock:
+        rows = db.execute(
+            f'SELECT {TRANSACTION_COLUMNS} FROM transactions WHERE {column} = ? '
+            'ORDER BY timestamp DESC, id DESC LIMIT ?',
+            (value, limit)
+        ).fetchall()
+    return [Transaction(*row[:-1], datetime.fromtimestamp(row[-1])) for row in rows]
+
+@app.before_request
+def load_user():
+    # Resolve the logged-in user once per request for the routes below
+    user_id = session.get('user_id')
+    g.user = users.get(user_id) if user_id else None
 
 @app.route('/')
 def index():
-    if 'user_id' in session:
-        user = users.get(session['user_id'])
-        if user:
-            if user['role'] == 'student':
-                return redirect(url_for('student_dashboard'))
-            else:
-                return redirect(url_for('stall_dashboard'))
+    if g.user:
+        if g.user['role'] == 'student':
+            return redirect(url_for('student_dashboard'))
+        else:
+            return redirect(url_for('stall_dashboard'))
     return render_template('index.html')
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -42,18 +117,14 @@ def login():
             return render_template('login.html')
         
         # Check if user exists
-        user_id = None
-        for uid, user in users.items():
-            if user['name'].lower() == name.lower() and user['role'] == role:
-                user_id = uid
-                break
+        user_key = (name.lower(), role)
+        user_id = users_by_key.get(user_key)
         
         # Create new user if doesn't exist
         if not user_id:
-            global next_user_id
-            user_id = str(next_user_id)
-            users[user_id] = {'name': name, 'role': role}
-            next_user_id += 1
+            user_id = str(next(_user_id_gen))
+            users[user_id] = {'name': name, 'name_lower': user_key[0], 'role': role}
+            users_by_key[user_key] = user_id
             flash(f'Welcome to Zen School Food Tracker, {name}!', 'success')
         else:
             flash(f'Welcome back, {name}!', 'success')
@@ -75,90 +146,95 @@ def logout():
 
 @app.route('/student/dashboard')
 def student_dashboard():
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
-    user = users.get(session['user_id'])
+    user = g.user
     if not user or user['role'] != 'student':
         return redirect(url_for('login'))
     
-    # Calculate spending statistics
-    user_purchases = [p for p in purchases if p['user_id'] == session['user_id']]
+    version = last_write_for_user.get(session['user_id'], 0)
+    html = get_cached_dashboard('student', session['user_id'], version)
+    if html is not None:
+        return html
     
-    # Today's spending
-    today = datetime.now().date()
-    today_purchases = [p for p in user_purchases if p['timestamp'].date() == today]
-    today_spend = sum(p.get('total_price', p['price']) for p in today_purchases)
-    
-    # Weekly spending
-    week_ago = datetime.now() - timedelta(days=7)
-    week_purchases = [p for p in user_purchases if p['timestamp'] >= week_ago]
-    weekly_spend = sum(p.get('total_price', p['price']) for p in week_purchases)
+    # Calculate today's and weekly spending in one index range scan
+    now = datetime.now()
+    today_start = datetime.combine(now.date(), datetime.min.time()).timestamp()
+    week_ago = (now - timedelta(days=7)).timestamp()
+    with db_lock:
+        weekly_spend, today_spend, today_items = db.execute(
+            'SELECT COALESCE(SUM(total_price), 0), '
+            'COALESCE(SUM(CASE WHEN timestamp >= ? THEN total_price END), 0), '
+            'COUNT(CASE WHEN timestamp >= ? THEN 1 END) '
+            'FROM transactions WHERE user_id = ? AND timestamp >= ?',
+            (today_start, today_start, session['user_id'], week_ago)
+        ).fetchone()
     
     # Recent purchases (last 10)
-    recent_purchases = sorted(user_purchases, key=lambda x: x['timestamp'], reverse=True)[:10]
+    recent_purchases = recent_transactions('user_id', session['user_id'])
     
-    return render_template('student_dashboard.html', 
+    html = render_template('student_dashboard.html', 
                          user=user,
                          today_spend=today_spend,
                          weekly_spend=weekly_spend,
-                         today_items=len(today_purchases),
+                         today_items=today_items,
                          recent_purchases=recent_purchases)
+    return cache_dashboard('student', session['user_id'], version, html)
 
 @app.route('/stall/dashboard')
 def stall_dashboard():
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
-    user = users.get(session['user_id'])
+    user = g.user
     if not user or user['role'] != 'stall_owner':
         return redirect(url_for('login'))
     
-    # Calculate sales statistics for this stall owner
-    stall_sales = [s for s in sales if s['stall_owner'] == user['name']]
+    version = last_write_for_stall.get(user['name'], 0)
+    html = get_cached_dashboard('stall', session['user_id'], version)
+    if html is not None:
+        return html
     
-    total_sales = sum(s['quantity'] for s in stall_sales)
-    total_revenue = sum(s['total'] for s in stall_sales)
+    # Calculate sales statistics for this stall owner
+    with db_lock:
+        total_sales, total_revenue = db.execute(
+            'SELECT COALESCE(SUM(quantity), 0), COALESCE(SUM(total_price), 0) '
+            'FROM transactions WHERE stall_owner = ?',
+            (user['name'],)
+        ).fetchone()
     
     # Recent sales (last 10)
-    recent_sales = sorted(stall_sales, key=lambda x: x['timestamp'], reverse=True)[:10]
+    recent_sales = recent_transactions('stall_owner', user['name'])
     
     # Get menu items for this stall
-    stall_menu = {k: v for k, v in menu_items.items() if v['stall_owner'] == user['name']}
+    stall_menu = menu_by_owner.get(user['name'], {})
     
-    return render_template('stall_dashboard.html',
+    html = render_template('stall_dashboard.html',
                          user=user,
                          total_sales=total_sales,
                          total_revenue=total_revenue,
                          recent_sales=recent_sales,
                          menu_items=stall_menu)
+    return cache_dashboard('stall', session['user_id'], version, html)
 
 @app.route('/browse-menu')
 def browse_menu():
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
-    user = users.get(session['user_id'])
+    user = g.user
     if not user or user['role'] != 'student':
         return redirect(url_for('login'))
     
-    # Group menu items by stall owner
-    stalls = defaultdict(list)
-    for item_id, item in menu_items.items():
-        stalls[item['stall_owner']].append({
-            'id': item_id,
-            'name': item['name'],
-            'price': item['price']
-        })
+    # Group menu items by stall owner (rebuilt only after the menu changes)
+    global _stalls_cache
+    if _stalls_cache is None:
+        stalls = defaultdict(list)
+        for item_id, item in menu_items.items():
+            stalls[item['stall_owner']].append({
+                'id': item_id,
+                'name': item['name'],
+                'price': item['price']
+            })
+        _stalls_cache = dict(stalls)
     
-    return render_template('browse_menu.html', user=user, stalls=dict(stalls))
+    return render_template('browse_menu.html', user=user, stalls=_stalls_cache)
 
 @app.route('/add-menu-item', methods=['GET', 'POST'])
 def add_menu_item():
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
-    user = users.get(session['user_id'])
+    user = g.user
     if not user or user['role'] != 'stall_owner':
         return redirect(url_for('login'))
     
@@ -178,13 +254,16 @@ def add_menu_item():
             flash('Please enter a valid price', 'error')
             return render_template('add_menu_item.html', user=user)
         
-        global next_item_id
-        menu_items[str(next_item_id)] = {
+        global _stalls_cache
+        item_id = str(next(_item_id_gen))
+        menu_items[item_id] = {
             'name': name,
             'price': price,
             'stall_owner': user['name']
         }
-        next_item_id += 1
+        menu_by_owner[user['name']][item_id] = menu_items[item_id]
+        _stalls_cache = None
+        last_write_for_stall[user['name']] += 1
         
         flash(f'Added {name} to your menu!', 'success')
         return redirect(url_for('stall_dashboard'))
@@ -199,17 +278,15 @@ def record_sale():
 
 @app.route('/log-purchase', methods=['POST'])
 def log_purchase():
-    if 'user_id' not in session:
-        return redirect(url_for('login'))
-    
-    user = users.get(session['user_id'])
+    user = g.user
     if not user or user['role'] != 'student':
         return redirect(url_for('login'))
     
     item_id = request.form.get('item_id')
     quantity_str = request.form.get('quantity', '1').strip()
     
-    if not item_id or item_id not in menu_items:
+    item = menu_items.get(item_id)
+    if item is None:
         flash('Invalid item selected', 'error')
         return redirect(url_for('browse_menu'))
     
@@ -221,36 +298,23 @@ def log_purchase():
         flash('Please enter a valid quantity (1-99)', 'error')
         return redirect(url_for('browse_menu'))
     
-    item = menu_items[item_id]
     total_price = item['price'] * quantity
+    now = datetime.now()
     
-    # Log the purchase for the student
-    purchases.append({
-        'user_id': session['user_id'],
-        'item_id': item_id,
-        'item_name': item['name'],
-        'stall_name': item['stall_owner'],
-        'price': item['price'],
-        'quantity': quantity,
-        'total_price': total_price,
-        'timestamp': datetime.now()
-    })
+    # Log one transaction; it is both the student's purchase and the stall's sale
+    with db_lock, db:
+        db.execute(
+            f'INSERT INTO transactions ({TRANSACTION_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (session['user_id'], user['name'], item_id, item['name'], item['stall_owner'],
+             item['price'], quantity, total_price, now.timestamp())
+        )
     
-    # Automatically record the sale for the stall owner
-    sales.append({
-        'item_id': item_id,
-        'item_name': item['name'],
-        'quantity': quantity,
-        'total': total_price,
-        'timestamp': datetime.now(),
-        'stall_owner': item['stall_owner'],
-        'buyer_name': user['name']
-    })
+    # Invalidate the cached dashboards for the buyer and the stall
+    last_write_for_user[session['user_id']] += 1
+    last_write_for_stall[item['stall_owner']] += 1
     
-    if quantity == 1:
-        flash(f'Purchased {item["name"]} for ₹{total_price:.2f}!', 'success')
-    else:
-        flash(f'Purchased {quantity}x {item["name"]} for ₹{total_price:.2f}!', 'success')
+    purchased = item['name'] if quantity == 1 else f'{quantity}x {item["name"]}'
+    flash(f'Purchased {purchased} for ₹{total_price:.2f}!', 'success')
     
     return redirect(url_for('browse_menu'))
 